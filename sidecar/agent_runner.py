@@ -3,9 +3,9 @@ Agent runner for executing code_puppy agents.
 """
 
 import asyncio
-import base64
-import sys
-import traceback
+import binascii
+import logging
+from collections import OrderedDict
 from typing import Optional, List, Dict, Any
 
 from pydantic_ai import BinaryContent
@@ -17,92 +17,91 @@ from code_puppy.messaging import (
     reset_message_bus,
 )
 
-from message_handler import MessageHandler
+from message_handler import MessageHandler, emit_batch
+
+logger = logging.getLogger("sidecar.agent")
+
+# Number of loaded agents kept warm for quick agent/model switching
+AGENT_POOL_SIZE = 4
 
 
 class AgentRunner:
     """Handles running code_puppy agents."""
 
+    __slots__ = (
+        'sio',
+        'message_handler',
+        'config_handler',
+        '_agent_pool',
+        '_credentials_version',
+    )
+
+    # Largest decoded image accepted from the GUI
+    MAX_IMAGE_BYTES = 32 * 1024 * 1024
+
     def __init__(self, sio, message_handler: MessageHandler, config_handler):
         self.sio = sio
         self.message_handler = message_handler
         self.config_handler = config_handler
-        self._current_agent = None
-        self._current_agent_name: Optional[str] = None
+        # Loaded agents keyed by (agent_name, model_name, credentials_version), LRU order
+        self._agent_pool: OrderedDict = OrderedDict()
         self._credentials_version = 0
 
     def increment_credentials_version(self):
         """Increment credentials version to force agent reload."""
         self._credentials_version += 1
-        if self._current_agent is not None:
-            self._current_agent._code_generation_agent = None
-            print(f"[Sidecar] Credentials changed - cleared cached pydantic agent")
+        logger.info("Credentials changed - pooled agents will be reloaded")
 
-    def reset_agent(self):
-        """Reset the current agent."""
-        self._current_agent = None
-        self._current_agent_name = None
+    def _latest_pooled(self, agent_name: str):
+        """Most recently used pooled agent with this name, or None."""
+        for (name, _model, _version), agent in reversed(self._agent_pool.items()):
+            if name == agent_name:
+                return agent
+        return None
 
     async def run_prompt(self, sid: str, prompt_text: str, images: List[Dict[str, Any]] = None):
         """Run a prompt through code_puppy agent."""
-        print(f"[Sidecar] run_prompt called with text={prompt_text[:50]}... images={len(images) if images else 0}")
-        sys.stdout.flush()
-
-        print(f"[Sidecar] Getting message bus...")
-        sys.stdout.flush()
-        bus = get_message_bus()
-        print(f"[Sidecar] Got message bus")
-        sys.stdout.flush()
+        logger.debug("run_prompt called with text=%s... images=%d", prompt_text[:50], len(images) if images else 0)
 
         try:
             default_agent = self.config_handler.default_agent
             default_model = self.config_handler.default_model
 
-            # Check if we need to reload the agent
-            need_new_agent = (
-                self._current_agent is None or
-                self._current_agent_name != default_agent
-            )
+            pool_key = (default_agent, default_model, self._credentials_version)
+            agent = self._agent_pool.get(pool_key)
+            # The conversation follows the agent across model and credential changes
+            previous = self._latest_pooled(default_agent)
 
-            # Also check if the model changed
-            model_changed = False
-            if self._current_agent is not None:
-                current_model = self._current_agent.get_model_name()
-                if current_model != default_model:
-                    model_changed = True
-                    print(f"[Sidecar] Model changed from {current_model} to {default_model}")
-                    sys.stdout.flush()
-
-            if need_new_agent:
-                print(f"[Sidecar] Need to load new agent: {default_agent}")
-                sys.stdout.flush()
+            if agent is None:
+                logger.debug("Need to load new agent: %s", default_agent)
+                # Only a cold load resets the bus; pooled agents keep the current one
                 reset_message_bus()
-                bus = get_message_bus()
-                print(f"[Sidecar] Message bus reset, loading agent...")
-                sys.stdout.flush()
+                logger.debug("Message bus reset, loading agent...")
 
                 agent = load_agent(default_agent)
-                print(f"[Sidecar] load_agent returned: {agent}")
-                sys.stdout.flush()
+                logger.debug("load_agent returned: %s", agent)
                 if not agent:
-                    await self.sio.emit('error', {
-                        'message': f'Failed to load agent: {default_agent}'
-                    }, room=sid)
-                    await self.sio.emit('task_complete', {}, room=sid)
+                    await emit_batch(self.sio, sid, [
+                        ('error', {'message': f'Failed to load agent: {default_agent}'}),
+                        ('task_complete', {}),
+                    ])
                     return
 
-                self._current_agent = agent
-                self._current_agent_name = default_agent
-                print(f"[Sidecar] Loaded new agent: {default_agent}")
+                self._agent_pool[pool_key] = agent
+                if len(self._agent_pool) > AGENT_POOL_SIZE:
+                    self._agent_pool.popitem(last=False)
+                logger.info("Loaded new agent: %s (model %s)", default_agent, default_model)
             else:
-                agent = self._current_agent
-                print(f"[Sidecar] Reusing existing agent: {default_agent}")
+                self._agent_pool.move_to_end(pool_key)
+                logger.debug("Reusing pooled agent: %s (model %s)", default_agent, default_model)
+
+            if previous is not None and previous is not agent:
+                agent.set_message_history(list(previous.get_message_history()))
 
-                if model_changed:
-                    print(f"[Sidecar] Forcing pydantic agent reload due to model change")
-                    sys.stdout.flush()
-                    agent._code_generation_agent = None
-                    agent._model_name = default_model
+            bus = get_message_bus()
+
+            # Convert images to BinaryContent attachments
+            attachments = await self._process_images(images)
 
             # Mark renderer active
             bus.mark_renderer_active()
@@ -112,50 +111,44 @@ class AgentRunner:
                 self.message_handler.consume_messages(sid, bus)
             )
 
-            # Convert images to BinaryContent attachments
-            attachments = self._process_images(images)
+            # Final events are sent together with task_complete in one frame
+            final_events = []
 
             try:
-                print(f"[Sidecar] Running agent.run_with_mcp with {len(attachments) if attachments else 0} attachments")
-                print(f"[Sidecar] Current model: {default_model}")
-                sys.stdout.flush()
+                logger.debug("Running agent.run_with_mcp with %d attachments", len(attachments) if attachments else 0)
+                logger.debug("Current model: %s", default_model)
 
                 result = await agent.run_with_mcp(
                     prompt_text,
                     attachments=attachments if attachments else None
                 )
 
-                print(f"[Sidecar] run_with_mcp returned successfully")
-                sys.stdout.flush()
+                logger.debug("run_with_mcp returned successfully")
 
-                # Give consumer time to process remaining messages
-                await asyncio.sleep(0.2)
+                # Let the consumer forward everything the run queued
+                await self.message_handler.wait_until_drained()
 
                 # Emit final response if available
                 response_output = self._extract_response(result, agent)
 
                 if response_output:
-                    print(f"[Sidecar] Emitting agent response")
-                    sys.stdout.flush()
-                    await self.sio.emit('message', {
+                    logger.debug("Emitting agent response")
+                    final_events.append(('message', {
                         'type': 'agent_response',
                         'content': response_output
-                    }, room=sid)
+                    }))
 
             except asyncio.CancelledError:
-                print("[Sidecar] Task was cancelled")
-                sys.stdout.flush()
-                await self.sio.emit('message', {
+                logger.info("Task was cancelled")
+                final_events.append(('message', {
                     'type': 'status',
                     'content': 'Task cancelled'
-                }, room=sid)
+                }))
             except Exception as e:
-                print(f"[Sidecar] Exception in agent.run_with_mcp: {e}")
-                traceback.print_exc()
-                sys.stdout.flush()
-                await self.sio.emit('error', {
+                logger.exception("Exception in agent.run_with_mcp: %s", e)
+                final_events.append(('error', {
                     'message': str(e)
-                }, room=sid)
+                }))
             finally:
                 consumer_task.cancel()
                 try:
@@ -164,52 +157,76 @@ class AgentRunner:
                     pass
                 bus.mark_renderer_inactive()
 
-            await self.sio.emit('task_complete', {}, room=sid)
+            final_events.append(('task_complete', {}))
+            await emit_batch(self.sio, sid, final_events)
 
         except Exception as e:
-            traceback.print_exc()
-            await self.sio.emit('error', {'message': str(e)}, room=sid)
-            await self.sio.emit('task_complete', {}, room=sid)
-
-    def _process_images(self, images: List[Dict[str, Any]] = None) -> List[BinaryContent]:
-        """Convert image data URLs to BinaryContent attachments."""
+            logger.exception("Error running prompt: %s", e)
+            await emit_batch(self.sio, sid, [
+                ('error', {'message': str(e)}),
+                ('task_complete', {}),
+            ])
+
+    async def _process_images(self, images: List[Dict[str, Any]] = None) -> List[BinaryContent]:
+        """Convert image data URLs to BinaryContent attachments off the event loop."""
         if not images:
             return None
 
-        attachments = []
-        for img in images:
-            try:
-                data_url = img.get('dataUrl', '')
-                mime_type = img.get('mimeType', 'image/png')
-
-                if data_url.startswith('data:'):
-                    parts = data_url.split(',', 1)
-                    if len(parts) == 2:
-                        base64_data = parts[1]
-                        image_bytes = base64.b64decode(base64_data)
-                        attachments.append(BinaryContent(data=image_bytes, media_type=mime_type))
-                        print(f"[Sidecar] Added image attachment: {img.get('name', 'unknown')} ({len(image_bytes)} bytes)")
-            except Exception as e:
-                print(f"[Sidecar] Error processing image: {e}")
-
+        loop = asyncio.get_running_loop()
+        decoded = await asyncio.gather(*(
+            loop.run_in_executor(None, self._decode_image, img) for img in images
+        ))
+        attachments = [attachment for attachment in decoded if attachment is not None]
         return attachments if attachments else None
 
+    @staticmethod
+    def _decode_image(img: Dict[str, Any]) -> Optional[BinaryContent]:
+        """Decode a single image data URL. Runs in a worker thread."""
+        try:
+            data_url = img.get('dataUrl', '')
+            mime_type = img.get('mimeType', 'image/png')
+            name = img.get('name', 'unknown')
+
+            # Check the (slightly over-)estimated decoded size before copying anything
+            estimated_size = (len(data_url) * 3) // 4
+            if estimated_size > AgentRunner.MAX_IMAGE_BYTES:
+                logger.warning("Skipping image %s: ~%d bytes exceeds limit of %d",
+                               name, estimated_size, AgentRunner.MAX_IMAGE_BYTES)
+                return None
+
+            raw = data_url.encode('ascii', 'ignore')
+            if raw.startswith(b'data:'):
+                comma = raw.find(b',')
+                if comma >= 0:
+                    # Decode straight from a view of the payload to avoid copying it
+                    image_bytes = binascii.a2b_base64(memoryview(raw)[comma + 1:])
+                    if len(image_bytes) > AgentRunner.MAX_IMAGE_BYTES:
+                        logger.warning("Skipping image %s: %d bytes exceeds limit", name, len(image_bytes))
+                        return None
+                    logger.debug("Added image attachment: %s (%d bytes)", name, len(image_bytes))
+                    return BinaryContent(data=image_bytes, media_type=mime_type)
+        except Exception as e:
+            logger.warning("Error processing image: %s", e)
+        return None
+
     def _extract_response(self, result, agent) -> Optional[str]:
         """Extract response from agent result or message history."""
         response_output = None
 
-        if result:
-            response_output = str(result.output) if hasattr(result, 'output') else str(result)
-        elif result is None:
+        if result is not None:
+            output = getattr(result, 'output', result)
+            response_output = output if isinstance(output, str) else str(output)
+
+        if not response_output:
             # Try to get the response from the agent's message history
             history = agent.get_message_history()
             if history:
                 last_msg = history[-1]
-                if hasattr(last_msg, 'parts'):
-                    for part in last_msg.parts:
-                        if hasattr(part, 'content') and isinstance(part.content, str):
-                            response_output = part.content
-                            print(f"[Sidecar] Found response in history: {response_output[:100]}...")
-                            break
+                for part in getattr(last_msg, 'parts', ()):
+                    content = getattr(part, 'content', None)
+                    if isinstance(content, str):
+                        response_output = content
+                        logger.debug("Found response in history: %s...", response_output[:100])
+                        break
 
         return response_output
@@ -2,55 +2,134 @@
 Configuration handler for the GUI sidecar.
 """
 
-import json
+import asyncio
+import functools
+import logging
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+
+import orjson
 
 import code_puppy
 from code_puppy import config
-from code_puppy.agents import get_available_agents, get_agent_descriptions
+from code_puppy.agents import get_available_agents
+
+from message_handler import emit_batch
+
+logger = logging.getLogger("sidecar.config")
+
+# API keys shown (masked) in the GUI settings
+API_KEY_NAMES = (
+    "OPENAI_API_KEY",
+    "ANTHROPIC_API_KEY",
+    "GEMINI_API_KEY",
+    "CEREBRAS_API_KEY",
+    "OPENROUTER_API_KEY",
+    "AZURE_OPENAI_API_KEY",
+    "AZURE_OPENAI_ENDPOINT",
+)
+
+_MASK_STARS = '*' * 8
+
+@functools.lru_cache(maxsize=None)
+def _oauth_models_loader():
+    """Import the OAuth model loader on first use. Returns None if the plugin is missing."""
+    try:
+        from code_puppy.plugins.claude_code_oauth.utils import load_claude_models_filtered
+    except ImportError:
+        return None
+    return load_claude_models_filtered
+
+
+@functools.lru_cache(maxsize=None)
+def oauth_models_path() -> Optional[Path]:
+    """Path of the Claude Code OAuth models file, if the plugin exposes it."""
+    try:
+        from code_puppy.plugins.claude_code_oauth.config import get_claude_models_path
+    except ImportError:
+        return None
+    return get_claude_models_path()
+
+
+def file_mtime_ns(path: Optional[Path]) -> Optional[int]:
+    """Modification time of a file, or None when it is missing."""
+    if path is None:
+        return None
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _models_file() -> Path:
+    """Location of code_puppy's bundled models.json."""
+    return Path(code_puppy.__file__).parent / 'models.json'
+
+
+@functools.lru_cache(maxsize=4)
+def _load_models(models_mtime: Optional[int], oauth_models_mtime: Optional[int]) -> List[str]:
+    """Build the sorted model list. Cached per (models.json, OAuth models file) mtime."""
+    models = set()
+    if models_mtime is not None:
+        models.update(orjson.loads(_models_file().read_bytes()).keys())
 
-# Import OAuth utilities for model loading
-try:
-    from code_puppy.plugins.claude_code_oauth.utils import load_claude_models_filtered
-    OAUTH_AVAILABLE = True
-except ImportError:
-    OAUTH_AVAILABLE = False
+    # Also include Claude Code OAuth models if available
+    load_claude_models_filtered = _oauth_models_loader()
+    if load_claude_models_filtered is not None:
+        try:
+            models.update(load_claude_models_filtered().keys())
+        except Exception:
+            pass
+    return sorted(models)
+
+
+def invalidate_models_cache():
+    """Drop cached model lists, e.g. after OAuth models were added or removed."""
+    _load_models.cache_clear()
 
 
 def get_available_models() -> List[str]:
     """Get list of available models from code_puppy's models.json and OAuth models."""
-    models = set()
     try:
-        pkg_dir = Path(code_puppy.__file__).parent
-        models_file = pkg_dir / 'models.json'
-        if models_file.exists():
-            with open(models_file) as f:
-                data = json.load(f)
-            models.update(data.keys())
-
-        # Also include Claude Code OAuth models if available
-        if OAUTH_AVAILABLE:
-            try:
-                claude_models = load_claude_models_filtered()
-                models.update(claude_models.keys())
-            except Exception:
-                pass
-        return sorted(models)
+        return _load_models(file_mtime_ns(_models_file()), file_mtime_ns(oauth_models_path()))
     except Exception as e:
-        print(f"[Sidecar] Error loading models: {e}")
+        logger.error("Error loading models: %s", e)
         return []
 
 
 class ConfigHandler:
     """Handles configuration operations for the sidecar."""
 
+    __slots__ = (
+        'sio',
+        '_default_agent',
+        '_default_model',
+        '_working_directory',
+        '_config_snapshot',
+        '_io_executor',
+        '_io_lock',
+        '_agents_payload',
+        '_agents_csv',
+    )
+
     def __init__(self, sio):
         self.sio = sio
-        self._default_agent = config.get_default_agent() or "code-puppy"
+        # Interned so the per-prompt agent comparison is a pointer check
+        self._default_agent = sys.intern(config.get_default_agent() or "code-puppy")
         self._default_model = config.get_global_model_name()
         self._working_directory = os.getcwd()
+        # In-memory copy of persisted config values, rebuilt lazily after a write
+        self._config_snapshot = None
+        # Config writes rewrite files on disk; run them off the event loop, one at a time
+        self._io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='sidecar-io')
+        self._io_lock = threading.Lock()
+        # The agent list only changes with the installed plugin set; built on first use
+        self._agents_payload = None
+        self._agents_csv = None
 
     @property
     def default_agent(self) -> str:
@@ -58,7 +137,7 @@ class ConfigHandler:
 
     @default_agent.setter
     def default_agent(self, value: str):
-        self._default_agent = value
+        self._default_agent = sys.intern(value)
 
     @property
     def default_model(self) -> str:
@@ -68,6 +147,20 @@ class ConfigHandler:
     def default_model(self, value: str):
         self._default_model = value
 
+    @property
+    def available_agents_csv(self) -> str:
+        """Comma-separated names of the available agents."""
+        if self._agents_csv is None:
+            self._load_agents()
+        return self._agents_csv
+
+    @property
+    def agents_payload(self) -> List[Dict[str, str]]:
+        """The 'available.agents' section of the config payload."""
+        if self._agents_payload is None:
+            self._load_agents()
+        return self._agents_payload
+
     @property
     def working_directory(self) -> str:
         return self._working_directory
@@ -76,133 +169,182 @@ class ConfigHandler:
     def working_directory(self, value: str):
         self._working_directory = value
 
+    def _apply_writes(self, writes: List[tuple]):
+        """Run config setter calls in order. Executes on the I/O executor."""
+        with self._io_lock:
+            for setter, *args in writes:
+                setter(*args)
+
+    async def _write_config(self, writes: List[tuple]):
+        """Persist (setter, *args) config writes without blocking the event loop."""
+        if not writes:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._io_executor, self._apply_writes, writes)
+        finally:
+            self.invalidate_config_snapshot()
+
+    @staticmethod
+    def _build_agents_payload() -> List[Dict[str, str]]:
+        """Build the 'available.agents' section of the config payload."""
+        from code_puppy.agents import get_agent_descriptions
+
+        agents = get_available_agents()
+        agent_descs = get_agent_descriptions()
+        return [
+            {'name': name, 'label': agents.get(name, name), 'description': agent_descs.get(name, '')}
+            for name in agents.keys()
+        ]
+
+    def _load_agents(self):
+        """Discover agents and cache the payload and name list."""
+        self._agents_payload = self._build_agents_payload()
+        self._agents_csv = ", ".join(agent['name'] for agent in self._agents_payload)
+
+    def refresh_agents(self):
+        """Drop the cached agent list, e.g. after agents were registered; rebuilt on next use."""
+        self._agents_payload = None
+        self._agents_csv = None
+
+    def config_snapshot(self) -> Dict[str, Any]:
+        """Read all persisted config values used by the GUI once and serve them from memory."""
+        if self._config_snapshot is None:
+            self._config_snapshot = {
+                'temperature': config.get_temperature(),
+                'yolo_mode': config.get_yolo_mode(),
+                'auto_save': config.get_auto_save_session(),
+                'suppress_thinking': config.get_suppress_thinking_messages(),
+                'suppress_info': config.get_suppress_informational_messages(),
+                'api_keys': {name: config.get_api_key(name) for name in API_KEY_NAMES},
+                'model_pinning': config.get_all_agent_pinned_models(),
+            }
+        return self._config_snapshot
+
+    def invalidate_config_snapshot(self):
+        """Force the next config_snapshot() call to re-read persisted values."""
+        self._config_snapshot = None
+
     async def get_config(self, sid: str):
         """Get current configuration."""
+        emit = self.sio.emit
         try:
-            agents = get_available_agents()
-            agent_descs = get_agent_descriptions()
             models = get_available_models()
 
+            snapshot = self.config_snapshot()
+
             # Get API keys (masked for display)
-            api_key_names = [
-                "OPENAI_API_KEY",
-                "ANTHROPIC_API_KEY",
-                "GEMINI_API_KEY",
-                "CEREBRAS_API_KEY",
-                "OPENROUTER_API_KEY",
-                "AZURE_OPENAI_API_KEY",
-                "AZURE_OPENAI_ENDPOINT",
-            ]
             api_keys = {}
-            for key_name in api_key_names:
-                value = config.get_api_key(key_name)
-                api_keys[key_name] = {
-                    'is_set': bool(value),
-                    'masked': f"{'*' * 8}...{value[-4:]}" if value and len(value) > 4 else ('****' if value else ''),
-                }
-
-            # Get model pinning
-            model_pinning = config.get_all_agent_pinned_models()
+            for key_name, value in snapshot['api_keys'].items():
+                if not value:
+                    api_keys[key_name] = {'is_set': False, 'masked': ''}
+                    continue
+                masked = f"{_MASK_STARS}...{value[-4:]}" if len(value) > 4 else '****'
+                api_keys[key_name] = {'is_set': True, 'masked': masked}
 
             cfg = {
                 'current': {
-                    'agent': config.get_default_agent() or 'code-puppy',
-                    'model': config.get_global_model_name(),
-                    'temperature': config.get_temperature(),
-                    'yolo_mode': config.get_yolo_mode(),
-                    'auto_save': config.get_auto_save_session(),
-                    'suppress_thinking': config.get_suppress_thinking_messages(),
-                    'suppress_info': config.get_suppress_informational_messages(),
+                    'agent': self._default_agent,
+                    'model': self._default_model,
+                    'temperature': snapshot['temperature'],
+                    'yolo_mode': snapshot['yolo_mode'],
+                    'auto_save': snapshot['auto_save'],
+                    'suppress_thinking': snapshot['suppress_thinking'],
+                    'suppress_info': snapshot['suppress_info'],
                 },
                 'available': {
-                    'agents': [
-                        {'name': name, 'label': agents.get(name, name), 'description': agent_descs.get(name, '')}
-                        for name in agents.keys()
-                    ],
+                    'agents': self.agents_payload,
                     'models': models,
                 },
                 'api_keys': api_keys,
-                'model_pinning': model_pinning,
+                'model_pinning': snapshot['model_pinning'],
             }
-            await self.sio.emit('config', cfg, room=sid)
+            await emit('config', cfg, room=sid)
         except Exception as e:
-            print(f"[Sidecar] Error getting config: {e}")
-            await self.sio.emit('error', {'message': f'Failed to get config: {e}'}, room=sid)
+            logger.error("Error getting config: %s", e)
+            await emit('error', {'message': f'Failed to get config: {e}'}, room=sid)
 
-    async def set_config(self, sid: str, data: Dict[str, Any]) -> tuple:
-        """Update configuration. Returns (success, should_reset_agent)."""
-        should_reset_agent = False
+    async def set_config(self, sid: str, data: Dict[str, Any]):
+        """Update configuration."""
         try:
             changes = []
+            writes = []
 
+            agent_name = None
             if 'agent' in data:
-                agent_name = data['agent']
-                config.set_default_agent(agent_name)
-                self._default_agent = agent_name
-                should_reset_agent = True
+                agent_name = sys.intern(data['agent'])
+                # Re-selecting the current agent needs no write
+                if agent_name is not self._default_agent:
+                    writes.append((config.set_default_agent, agent_name))
                 changes.append(f"Agent: {agent_name}")
 
             if 'model' in data:
                 model_name = data['model']
-                config.set_model_name(model_name)
-                self._default_model = model_name
+                writes.append((config.set_model_name, model_name))
                 changes.append(f"Model: {model_name}")
 
             if 'temperature' in data:
                 temp = data['temperature']
                 if temp is not None:
-                    config.set_temperature(float(temp))
+                    writes.append((config.set_temperature, float(temp)))
                 changes.append(f"Temperature: {temp}")
 
             if 'yolo_mode' in data:
                 changes.append(f"YOLO mode: {data['yolo_mode']} (session only)")
 
             if 'auto_save' in data:
-                config.set_auto_save_session(data['auto_save'])
+                writes.append((config.set_auto_save_session, data['auto_save']))
                 changes.append(f"Auto-save: {data['auto_save']}")
 
             if 'suppress_thinking' in data:
-                config.set_suppress_thinking_messages(data['suppress_thinking'])
+                writes.append((config.set_suppress_thinking_messages, data['suppress_thinking']))
                 changes.append(f"Suppress thinking: {data['suppress_thinking']}")
 
             if 'suppress_info' in data:
-                config.set_suppress_informational_messages(data['suppress_info'])
+                writes.append((config.set_suppress_informational_messages, data['suppress_info']))
                 changes.append(f"Suppress info: {data['suppress_info']}")
 
-            await self.sio.emit('config_updated', {
-                'success': True,
-                'changes': changes
-            }, room=sid)
-
-            await self.sio.emit('message', {
-                'type': 'status',
-                'content': 'Configuration updated:\n' + '\n'.join(f'  • {c}' for c in changes)
-            }, room=sid)
+            await self._write_config(writes)
 
-            return True, should_reset_agent
+            if agent_name is not None:
+                self._default_agent = agent_name
+            if 'model' in data:
+                self._default_model = data['model']
+
+            await emit_batch(self.sio, sid, [
+                ('config_updated', {
+                    'success': True,
+                    'changes': changes
+                }),
+                ('message', {
+                    'type': 'status',
+                    'content': 'Configuration updated:\n' + '\n'.join(f'  • {c}' for c in changes)
+                }),
+            ])
 
         except Exception as e:
-            print(f"[Sidecar] Error setting config: {e}")
+            logger.error("Error setting config: %s", e)
             await self.sio.emit('config_updated', {
                 'success': False,
                 'error': str(e)
             }, room=sid)
-            return False, False
 
     async def set_api_key(self, sid: str, data: Dict[str, Any]):
         """Set an API key."""
+        emit = self.sio.emit
         try:
             key_name = data.get('key_name')
             value = data.get('value', '')
 
             if not key_name:
-                await self.sio.emit('api_key_result', {
+                await emit('api_key_result', {
                     'success': False,
                     'error': 'Key name is required'
                 }, room=sid)
                 return
 
-            config.set_api_key(key_name, value)
+            await self._write_config([(config.set_api_key, key_name, value)])
+            invalidate_models_cache()
 
             # Also set in environment for current session
             if value:
@@ -210,40 +352,41 @@ class ConfigHandler:
             elif key_name in os.environ:
                 del os.environ[key_name]
 
-            await self.sio.emit('api_key_result', {
+            await emit('api_key_result', {
                 'success': True,
                 'key_name': key_name,
                 'message': f'{key_name} {"set" if value else "cleared"}'
             }, room=sid)
 
         except Exception as e:
-            print(f"[Sidecar] Error setting API key: {e}")
-            await self.sio.emit('api_key_result', {
+            logger.error("Error setting API key: %s", e)
+            await emit('api_key_result', {
                 'success': False,
                 'error': str(e)
             }, room=sid)
 
     async def set_model_pin(self, sid: str, data: Dict[str, Any]):
         """Set or clear a model pin for an agent."""
+        emit = self.sio.emit
         try:
             agent_name = data.get('agent_name')
             model_name = data.get('model_name', '')
 
             if not agent_name:
-                await self.sio.emit('model_pin_result', {
+                await emit('model_pin_result', {
                     'success': False,
                     'error': 'Agent name is required'
                 }, room=sid)
                 return
 
             if model_name:
-                config.set_agent_pinned_model(agent_name, model_name)
+                await self._write_config([(config.set_agent_pinned_model, agent_name, model_name)])
                 message = f'Agent "{agent_name}" pinned to model "{model_name}"'
             else:
-                config.clear_agent_pinned_model(agent_name)
+                await self._write_config([(config.clear_agent_pinned_model, agent_name)])
                 message = f'Model pin cleared for agent "{agent_name}"'
 
-            await self.sio.emit('model_pin_result', {
+            await emit('model_pin_result', {
                 'success': True,
                 'agent_name': agent_name,
                 'model_name': model_name,
@@ -251,18 +394,19 @@ class ConfigHandler:
             }, room=sid)
 
         except Exception as e:
-            print(f"[Sidecar] Error setting model pin: {e}")
-            await self.sio.emit('model_pin_result', {
+            logger.error("Error setting model pin: %s", e)
+            await emit('model_pin_result', {
                 'success': False,
                 'error': str(e)
             }, room=sid)
 
     async def set_working_directory(self, sid: str, data: Dict[str, Any]):
         """Set the working directory."""
+        emit = self.sio.emit
         try:
             new_path = data.get('path', '')
             if not new_path:
-                await self.sio.emit('working_directory_result', {
+                await emit('working_directory_result', {
                     'success': False,
                     'error': 'Path is required'
                 }, room=sid)
@@ -270,34 +414,36 @@ class ConfigHandler:
 
             # Validate path exists and is a directory
             if not os.path.isdir(new_path):
-                await self.sio.emit('working_directory_result', {
+                await emit('working_directory_result', {
                     'success': False,
                     'error': f'Path does not exist or is not a directory: {new_path}'
                 }, room=sid)
                 return
 
-            # Change directory
+            # code_puppy's tools (file access, shell commands) resolve paths
+            # against the process working directory
+            new_path = os.path.abspath(new_path)
             os.chdir(new_path)
             self._working_directory = new_path
 
-            await self.sio.emit('working_directory', {
-                'path': self._working_directory
-            }, room=sid)
-
-            await self.sio.emit('working_directory_result', {
-                'success': True,
-                'path': self._working_directory,
-                'message': f'Working directory changed to: {self._working_directory}'
-            }, room=sid)
-
-            await self.sio.emit('message', {
-                'type': 'status',
-                'content': f'Working directory changed to: {self._working_directory}'
-            }, room=sid)
+            await emit_batch(self.sio, sid, [
+                ('working_directory', {
+                    'path': self._working_directory
+                }),
+                ('working_directory_result', {
+                    'success': True,
+                    'path': self._working_directory,
+                    'message': f'Working directory changed to: {self._working_directory}'
+                }),
+                ('message', {
+                    'type': 'status',
+                    'content': f'Working directory changed to: {self._working_directory}'
+                }),
+            ])
 
         except Exception as e:
-            print(f"[Sidecar] Error setting working directory: {e}")
-            await self.sio.emit('working_directory_result', {
+            logger.error("Error setting working directory: %s", e)
+            await emit('working_directory_result', {
                 'success': False,
                 'error': str(e)
             }, room=sid)
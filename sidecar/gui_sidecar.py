@@ -6,6 +6,11 @@ Runs a Socket.IO server that bridges GUI commands to code_puppy agents.
 
 import argparse
 import asyncio
+import logging
+import logging.handlers
+import queue
+import signal
+import socket
 import sys
 import os
 from typing import Optional, Dict
@@ -14,187 +19,245 @@ from typing import Optional, Dict
 from logfire_mock import install_mock
 install_mock()
 
+import orjson
 import socketio
 from aiohttp import web
 
-from code_puppy.agents import get_available_agents
+# uvloop is optional (unavailable on Windows); fall back to the default loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 from config_handler import ConfigHandler
 from oauth_handler import OAuthHandler
-from message_handler import MessageHandler
+from message_handler import MessageHandler, emit_batch
 from agent_runner import AgentRunner
 
+logger = logging.getLogger("sidecar")
+
+CONNECT_STATUS_TEMPLATE = (
+    'Connected to code_puppy\n'
+    'Agent: {agent}\n'
+    'Model: {model}\n'
+    'Working directory: {working_directory}\n'
+    'Available agents: {agents}'
+)
+
+
+class OrjsonCodec:
+    """json-module compatible wrapper around orjson for python-socketio/engineio packets."""
+
+    @staticmethod
+    def dumps(obj, **kwargs) -> str:
+        # socket.io expects str; separators/other stdlib kwargs are irrelevant to orjson
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+
 
 class GUISidecar:
     """Socket.IO server that bridges GUI to code_puppy."""
 
+    __slots__ = (
+        'port',
+        'sio',
+        'app',
+        'config_handler',
+        'oauth_handler',
+        'message_handler',
+        'agent_runner',
+        '_stop_event',
+        '_clients',
+        '_pending_input',
+        '_pending_confirm',
+        '_pending_select',
+        '_current_task',
+    )
+
     def __init__(self, port: int = 0):
         self.port = port
-        self._running = False
+        self._stop_event = asyncio.Event()
 
         # Socket.IO server
         self.sio = socketio.AsyncServer(
             async_mode='aiohttp',
             cors_allowed_origins='*',
             logger=False,
-            engineio_logger=False
+            engineio_logger=False,
+            json=OrjsonCodec,
+            # Long-polling responses above 1 KB are gzip/deflate compressed;
+            # websocket frames use permessage-deflate, which aiohttp negotiates
+            http_compression=True,
+            compression_threshold=1024,
         )
         self.app = web.Application()
         self.sio.attach(self.app)
 
         # State
         self._clients: set = set()
-        self._pending_inputs: Dict[str, asyncio.Future] = {}
+        self._pending_input: Dict[int, asyncio.Future] = {}
+        self._pending_confirm: Dict[int, asyncio.Future] = {}
+        self._pending_select: Dict[int, asyncio.Future] = {}
         self._current_task: Optional[asyncio.Task] = None
 
         # Initialize handlers
         self.config_handler = ConfigHandler(self.sio)
         self.oauth_handler = OAuthHandler(self.sio)
-        self.message_handler = MessageHandler(self.sio, self._pending_inputs)
+        self.message_handler = MessageHandler(
+            self.sio, self._pending_input, self._pending_confirm, self._pending_select
+        )
         self.agent_runner = AgentRunner(self.sio, self.message_handler, self.config_handler)
 
         self._setup_handlers()
 
     def _setup_handlers(self):
-        """Set up Socket.IO event handlers."""
-
-        @self.sio.event
-        async def connect(sid, environ):
-            print(f"[Sidecar] Client connected: {sid}")
-            self._clients.add(sid)
+        """Register Socket.IO event handlers."""
+        self.sio.on('connect', self._on_connect)
+        self.sio.on('disconnect', self._on_disconnect)
+        self.sio.on('prompt', self._on_prompt)
+        self.sio.on('cancel', self._on_cancel)
+        self.sio.on('input_response', self._on_input_response)
+        self.sio.on('confirmation_response', self._on_confirmation_response)
+        self.sio.on('selection_response', self._on_selection_response)
+        self.sio.on('get_config', self._on_get_config)
+        self.sio.on('set_config', self._on_set_config)
+        self.sio.on('set_api_key', self._on_set_api_key)
+        self.sio.on('set_model_pin', self._on_set_model_pin)
+        self.sio.on('set_working_directory', self._on_set_working_directory)
+        self.sio.on('oauth_status', self._on_oauth_status)
+        self.sio.on('oauth_start', self._on_oauth_start)
+        self.sio.on('oauth_logout', self._on_oauth_logout)
+
+    async def _on_connect(self, sid, environ):
+        """Greet a newly connected GUI client."""
+        logger.debug("Client connected: %s", sid)
+        self._clients.add(sid)
+
+        config_handler = self.config_handler
+        working_directory = config_handler.working_directory
+        await emit_batch(self.sio, sid, [
+            ('message', {
+                'type': 'status',
+                'content': CONNECT_STATUS_TEMPLATE.format(
+                    agent=config_handler.default_agent,
+                    model=config_handler.default_model,
+                    working_directory=working_directory,
+                    agents=config_handler.available_agents_csv,
+                )
+            }),
+            ('working_directory', {'path': working_directory}),
+        ])
+
+    async def _on_disconnect(self, sid):
+        """Forget a client and cancel its running task."""
+        logger.debug("Client disconnected: %s", sid)
+        self._clients.discard(sid)
+        self.message_handler.cancel_pending(sid)
+        if self._current_task and not self._current_task.done():
+            self._current_task.cancel()
+
+    async def _on_prompt(self, sid, data):
+        """Handle prompt from GUI."""
+        text = data.get('text', '').strip()
+        images = data.get('images', [])
+
+        if not text and not images:
+            await self.sio.emit('error', {'message': 'Empty prompt'}, room=sid)
+            return
+
+        logger.debug("Prompt: %s... (%d images)", text[:80], len(images))
+
+        if self._current_task and not self._current_task.done():
+            self._current_task.cancel()
+
+        self._current_task = asyncio.create_task(
+            self.agent_runner.run_prompt(sid, text, images)
+        )
 
-            agents = get_available_agents()
+    async def _on_cancel(self, sid, data=None):
+        """Cancel running task."""
+        if self._current_task and not self._current_task.done():
+            self._current_task.cancel()
             await self.sio.emit('message', {
                 'type': 'status',
-                'content': f'Connected to code_puppy\nAgent: {self.config_handler.default_agent}\nModel: {self.config_handler.default_model}\nWorking directory: {self.config_handler.working_directory}\nAvailable agents: {", ".join(agents)}'
-            }, room=sid)
-            await self.sio.emit('working_directory', {
-                'path': self.config_handler.working_directory
+                'content': 'Task cancelled'
             }, room=sid)
 
-        @self.sio.event
-        async def disconnect(sid):
-            print(f"[Sidecar] Client disconnected: {sid}")
-            self._clients.discard(sid)
-            if self._current_task and not self._current_task.done():
-                self._current_task.cancel()
-
-        @self.sio.event
-        async def prompt(sid, data):
-            """Handle prompt from GUI."""
-            text = data.get('text', '').strip()
-            images = data.get('images', [])
-
-            if not text and not images:
-                await self.sio.emit('error', {'message': 'Empty prompt'}, room=sid)
-                return
-
-            print(f"[Sidecar] Prompt: {text[:80]}... ({len(images)} images)")
-
-            if self._current_task and not self._current_task.done():
-                self._current_task.cancel()
-
-            self._current_task = asyncio.create_task(
-                self.agent_runner.run_prompt(sid, text, images)
-            )
-
-        @self.sio.event
-        async def cancel(sid, data=None):
-            """Cancel running task."""
-            if self._current_task and not self._current_task.done():
-                self._current_task.cancel()
-                await self.sio.emit('message', {
-                    'type': 'status',
-                    'content': 'Task cancelled'
-                }, room=sid)
-
-        @self.sio.event
-        async def input_response(sid, data):
-            """Handle user input response."""
-            prompt_id = data.get('prompt_id')
-            response = data.get('response', '')
-
-            if prompt_id in self._pending_inputs:
-                future = self._pending_inputs.pop(prompt_id)
-                if not future.done():
-                    future.set_result(('input', response))
-
-        @self.sio.event
-        async def confirmation_response(sid, data):
-            """Handle confirmation response."""
-            prompt_id = data.get('prompt_id')
-            confirmed = data.get('confirmed', False)
-            feedback = data.get('feedback')
-
-            if prompt_id in self._pending_inputs:
-                future = self._pending_inputs.pop(prompt_id)
-                if not future.done():
-                    future.set_result(('confirm', confirmed, feedback))
-
-        @self.sio.event
-        async def selection_response(sid, data):
-            """Handle selection response."""
-            prompt_id = data.get('prompt_id')
-            selected = data.get('selected', [])
-
-            if prompt_id in self._pending_inputs:
-                future = self._pending_inputs.pop(prompt_id)
-                if not future.done():
-                    future.set_result(('select', selected))
-
-        # ===== Configuration Events =====
-
-        @self.sio.event
-        async def get_config(sid, data=None):
-            """Get current configuration."""
-            await self.config_handler.get_config(sid)
-
-        @self.sio.event
-        async def set_config(sid, data):
-            """Update configuration."""
-            success, should_reset = await self.config_handler.set_config(sid, data)
-            if should_reset:
-                self.agent_runner.reset_agent()
-
-        @self.sio.event
-        async def set_api_key(sid, data):
-            """Set an API key."""
-            await self.config_handler.set_api_key(sid, data)
-
-        @self.sio.event
-        async def set_model_pin(sid, data):
-            """Set or clear a model pin for an agent."""
-            await self.config_handler.set_model_pin(sid, data)
-
-        @self.sio.event
-        async def set_working_directory(sid, data):
-            """Set the working directory."""
-            await self.config_handler.set_working_directory(sid, data)
-
-        # ===== OAuth Events =====
-
-        @self.sio.event
-        async def oauth_status(sid, data=None):
-            """Get Claude Code OAuth status."""
-            await self.oauth_handler.get_status(sid)
-
-        @self.sio.event
-        async def oauth_start(sid, data=None):
-            """Start Claude Code OAuth flow."""
-            await self.oauth_handler.start_flow(
-                sid,
-                on_complete_callback=self.agent_runner.increment_credentials_version
-            )
-
-        @self.sio.event
-        async def oauth_logout(sid, data=None):
-            """Remove Claude Code OAuth tokens."""
-            await self.oauth_handler.logout(sid)
+    async def _on_input_response(self, sid, data):
+        """Handle user input response."""
+        prompt_id = data.get('prompt_id')
+        response = data.get('response', '')
+
+        future = self._pending_input.pop(prompt_id, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    async def _on_confirmation_response(self, sid, data):
+        """Handle confirmation response."""
+        prompt_id = data.get('prompt_id')
+        confirmed = data.get('confirmed', False)
+        feedback = data.get('feedback')
+
+        future = self._pending_confirm.pop(prompt_id, None)
+        if future is not None and not future.done():
+            future.set_result((confirmed, feedback))
+
+    async def _on_selection_response(self, sid, data):
+        """Handle selection response."""
+        prompt_id = data.get('prompt_id')
+        selected = data.get('selected', [])
+
+        future = self._pending_select.pop(prompt_id, None)
+        if future is not None and not future.done():
+            future.set_result(selected)
+
+    # ===== Configuration Events =====
+
+    async def _on_get_config(self, sid, data=None):
+        """Get current configuration."""
+        await self.config_handler.get_config(sid)
+
+    async def _on_set_config(self, sid, data):
+        """Update configuration."""
+        # Agent switches are resolved through the agent pool on the next prompt,
+        # so previously loaded agents stay warm.
+        await self.config_handler.set_config(sid, data)
+
+    async def _on_set_api_key(self, sid, data):
+        """Set an API key."""
+        await self.config_handler.set_api_key(sid, data)
+
+    async def _on_set_model_pin(self, sid, data):
+        """Set or clear a model pin for an agent."""
+        await self.config_handler.set_model_pin(sid, data)
+
+    async def _on_set_working_directory(self, sid, data):
+        """Set the working directory."""
+        await self.config_handler.set_working_directory(sid, data)
+
+    # ===== OAuth Events =====
+
+    async def _on_oauth_status(self, sid, data=None):
+        """Get Claude Code OAuth status."""
+        await self.oauth_handler.get_status(sid)
+
+    async def _on_oauth_start(self, sid, data=None):
+        """Start Claude Code OAuth flow."""
+        await self.oauth_handler.start_flow(
+            sid,
+            on_complete_callback=self.agent_runner.increment_credentials_version
+        )
+
+    async def _on_oauth_logout(self, sid, data=None):
+        """Remove Claude Code OAuth tokens."""
+        await self.oauth_handler.logout(sid)
 
     async def run(self):
         """Run the sidecar server."""
         if self.port == 0:
-            import socket
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.bind(('127.0.0.1', 0))
                 self.port = s.getsockname()[1]
@@ -209,17 +272,43 @@ class GUISidecar:
         print(f"SIDECAR_READY port={self.port}")
         sys.stdout.flush()
 
-        print(f"[Sidecar] Running on http://127.0.0.1:{self.port}")
+        logger.info("Running on http://127.0.0.1:%d", self.port)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                pass  # Windows: KeyboardInterrupt is handled in __main__
 
-        self._running = True
         try:
-            while self._running:
-                await asyncio.sleep(1)
+            await self._stop_event.wait()
         except asyncio.CancelledError:
             pass
         finally:
             await runner.cleanup()
 
+    def stop(self):
+        """Ask the running server to shut down."""
+        self._stop_event.set()
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route sidecar logging through a background thread so writes never block the event loop."""
+    level = os.environ.get('SIDECAR_LOG_LEVEL', 'INFO').upper()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('[Sidecar] %(message)s'))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+
+    sidecar_logger = logging.getLogger('sidecar')
+    sidecar_logger.setLevel(level)
+    sidecar_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    sidecar_logger.propagate = False
+    return listener
+
 
 async def main(port: int):
     sidecar = GUISidecar(port=port)
@@ -231,7 +320,11 @@ if __name__ == '__main__':
     parser.add_argument('--port', '-p', type=int, default=0, help='Port (0 = auto)')
     args = parser.parse_args()
 
+    log_listener = setup_logging()
+    run = uvloop.run if uvloop is not None else asyncio.run
     try:
-        asyncio.run(main(args.port))
+        run(main(args.port))
     except KeyboardInterrupt:
-        print("\n[Sidecar] Shutting down...")
+        logger.info("Shutting down...")
+    finally:
+        log_listener.stop()
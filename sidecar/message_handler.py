@@ -3,9 +3,11 @@ Message handler for forwarding code_puppy messages to the GUI.
 """
 
 import asyncio
-import sys
-from queue import Empty
-from typing import Dict, Any
+import functools
+import itertools
+import logging
+from collections import defaultdict
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple
 
 from code_puppy.messaging import (
     MessageBus,
@@ -33,223 +35,471 @@ from code_puppy.messaging import (
     VersionCheckMessage,
 )
 
+# Most bus messages forwarded in one 'batch' frame
+MAX_BATCH_MESSAGES = 64
+
+# Output frames the GUI may leave unacknowledged before the consumer pauses
+MAX_INFLIGHT_FRAMES = 8
+# Longest a frame waits for a free slot before it is sent anyway
+ACK_TIMEOUT = 5.0
+
+# Text fields larger than this are streamed as content_start/chunk/end events
+CHUNK_SIZE = 64 * 1024
+# Payload types that can carry arbitrarily large text
+CHUNKED_TYPES = frozenset({'file_content', 'shell_output'})
+
+
+async def emit_batch(sio, sid: str, events: List[Tuple[str, Any]]):
+    """Emit several events to a client as a single 'batch' frame."""
+    if len(events) == 1:
+        event, data = events[0]
+        await sio.emit(event, data, room=sid)
+        return
+    await sio.emit('batch', [[event, data] for event, data in events], room=sid)
+
+
+logger = logging.getLogger("sidecar.messages")
+
+# Lookup tables shared by the serializers below
+_LEVEL_MAP = {
+    MessageLevel.DEBUG: 'debug',
+    MessageLevel.INFO: 'info',
+    MessageLevel.WARNING: 'warning',
+    MessageLevel.ERROR: 'error',
+    MessageLevel.SUCCESS: 'success',
+}
+_DIFF_PREFIX = {'add': '+', 'remove': '-', 'context': ' '}
+_DIVIDER_LINE = '─' * 40
+# Characters of a sub-agent prompt shown in its invocation line
+SUB_AGENT_PREVIEW_CHARS = 100
+
+
+def _serialize_text(msg: TextMessage) -> Optional[Dict[str, Any]]:
+    """Plain text output with its level."""
+    return {
+        'type': 'text',
+        'content': msg.text,
+        'level': _LEVEL_MAP.get(msg.level, 'info')
+    }
+
+
+def _serialize_file_content(msg: FileContentMessage) -> Optional[Dict[str, Any]]:
+    """Contents of a file read by a tool."""
+    return {
+        'type': 'file_content',
+        'path': msg.path,
+        'content': msg.content,
+        'start_line': msg.start_line,
+        'num_lines': msg.num_lines,
+        'total_lines': msg.total_lines,
+        'num_tokens': msg.num_tokens,
+    }
+
+
+def _serialize_diff(msg: DiffMessage) -> Optional[Dict[str, Any]]:
+    """File edit as structured lines plus a unified-style text body."""
+    diff_lines = msg.diff_lines
+    return {
+        'type': 'diff',
+        'path': msg.path,
+        'operation': msg.operation,
+        'diff_lines': [{'type': l.type, 'content': l.content, 'line_number': l.line_number} for l in diff_lines],
+        'content': '\n'.join(_DIFF_PREFIX.get(l.type, ' ') + l.content for l in diff_lines)
+    }
+
+
+def _serialize_shell_start(msg: ShellStartMessage) -> Optional[Dict[str, Any]]:
+    """Shell command about to run."""
+    return {
+        'type': 'shell_start',
+        'command': msg.command,
+        'content': f"$ {msg.command}"
+    }
+
+
+def _serialize_shell_output(msg: ShellOutputMessage) -> Optional[Dict[str, Any]]:
+    """Finished shell command output."""
+    stdout = msg.stdout
+    stderr = msg.stderr or ''
+    return {
+        'type': 'shell_output',
+        'command': msg.command,
+        'stdout': stdout,
+        'stderr': stderr,
+        'exit_code': msg.exit_code,
+        'content': stdout + stderr if stderr else stdout
+    }
+
+
+def _serialize_reasoning(msg: AgentReasoningMessage) -> Optional[Dict[str, Any]]:
+    """Agent reasoning and planned next steps."""
+    return {
+        'type': 'reasoning',
+        'content': msg.reasoning,
+        'next_steps': msg.next_steps,
+    }
+
+
+def _serialize_agent_response(msg: AgentResponseMessage) -> Optional[Dict[str, Any]]:
+    """Final agent response text."""
+    return {
+        'type': 'agent_response',
+        'content': msg.content
+    }
+
+
+def _serialize_sub_agent(msg: SubAgentInvocationMessage) -> Optional[Dict[str, Any]]:
+    """Sub-agent invocation."""
+    return {
+        'type': 'sub_agent',
+        'agent_name': msg.agent_name,
+        'prompt': msg.prompt,
+        'session_id': msg.session_id,
+        'is_new_session': msg.is_new_session,
+        'content': f"[{msg.agent_name}] {msg.prompt[:SUB_AGENT_PREVIEW_CHARS]}..."
+    }
+
+
+def _serialize_sub_agent_response(msg: SubAgentResponseMessage) -> Optional[Dict[str, Any]]:
+    """Sub-agent response."""
+    return {
+        'type': 'sub_agent_response',
+        'agent_name': msg.agent_name,
+        'session_id': msg.session_id,
+        'response': msg.response,
+        'content': msg.response
+    }
+
+
+def _serialize_spinner(msg: SpinnerControl) -> Optional[Dict[str, Any]]:
+    """Spinner start/stop/update."""
+    return {
+        'type': 'spinner',
+        'action': msg.action,
+        'spinner_id': msg.spinner_id,
+        'content': msg.text or ''
+    }
+
+
+def _serialize_grep_result(msg: GrepResultMessage) -> Optional[Dict[str, Any]]:
+    """Grep matches."""
+    return {
+        'type': 'grep_result',
+        'search_term': msg.search_term,
+        'directory': msg.directory,
+        'matches': [{'file_path': m.file_path, 'line_number': m.line_number, 'line_content': m.line_content} for m in msg.matches],
+        'total_matches': msg.total_matches,
+        'files_searched': msg.files_searched,
+    }
+
+
+def _serialize_file_listing(msg: FileListingMessage) -> Optional[Dict[str, Any]]:
+    """Directory listing."""
+    return {
+        'type': 'file_listing',
+        'directory': msg.directory,
+        'files': [{'path': f.path, 'type': f.type, 'size': f.size, 'depth': f.depth} for f in msg.files],
+        'recursive': msg.recursive,
+        'total_size': msg.total_size,
+        'dir_count': msg.dir_count,
+        'file_count': msg.file_count,
+    }
+
+
+def _serialize_status_panel(msg: StatusPanelMessage) -> Optional[Dict[str, Any]]:
+    """Titled panel of status fields."""
+    return {
+        'type': 'status_panel',
+        'title': msg.title,
+        'fields': msg.fields,
+    }
+
+
+def _serialize_divider(msg: DividerMessage) -> Optional[Dict[str, Any]]:
+    """Visual divider."""
+    return {
+        'type': 'divider',
+        'content': _DIVIDER_LINE
+    }
+
+
+def _serialize_version_check(msg: VersionCheckMessage) -> Optional[Dict[str, Any]]:
+    """Update notice, only when an update is available."""
+    if msg.update_available:
+        return {
+            'type': 'version_check',
+            'content': f"Update available: {msg.current_version} → {msg.latest_version}"
+        }
+    return None
+
+
+def _serialize_fallback(msg) -> Optional[Dict[str, Any]]:
+    """Generic text payload for message types without a dedicated serializer."""
+    content = getattr(msg, 'content', None) or getattr(msg, 'text', None)
+    if content:
+        return {
+            'type': 'text',
+            'content': str(content)
+        }
+    logger.warning("Unhandled message type: %s", type(msg).__name__)
+    return None
+
+
+def _split_large_payload(payload: Dict[str, Any], stream_ids: Iterator[int]) -> Optional[List[list]]:
+    """Split oversized text fields into content_start/chunk/end events, or None if small."""
+    large = [key for key, value in payload.items() if isinstance(value, str) and len(value) > CHUNK_SIZE]
+    if not large:
+        return None
+    stream_id = next(stream_ids)
+    head = {key: value for key, value in payload.items() if key not in large}
+    events = [['content_start', {'id': stream_id, 'message': head, 'fields': large}]]
+    for field in large:
+        text = payload[field]
+        for seq, start in enumerate(range(0, len(text), CHUNK_SIZE)):
+            events.append(['content_chunk', {
+                'id': stream_id,
+                'field': field,
+                'seq': seq,
+                'data': text[start:start + CHUNK_SIZE],
+            }])
+    events.append(['content_end', {'id': stream_id}])
+    return events
+
+
+# Exact message class -> 'message' payload builder
+_SERIALIZERS = {
+    TextMessage: _serialize_text,
+    FileContentMessage: _serialize_file_content,
+    DiffMessage: _serialize_diff,
+    ShellStartMessage: _serialize_shell_start,
+    ShellOutputMessage: _serialize_shell_output,
+    AgentReasoningMessage: _serialize_reasoning,
+    AgentResponseMessage: _serialize_agent_response,
+    SubAgentInvocationMessage: _serialize_sub_agent,
+    SubAgentResponseMessage: _serialize_sub_agent_response,
+    SpinnerControl: _serialize_spinner,
+    GrepResultMessage: _serialize_grep_result,
+    FileListingMessage: _serialize_file_listing,
+    StatusPanelMessage: _serialize_status_panel,
+    DividerMessage: _serialize_divider,
+    VersionCheckMessage: _serialize_version_check,
+}
+
 
 class MessageHandler:
     """Handles forwarding messages from code_puppy to the GUI."""
 
-    def __init__(self, sio, pending_inputs: Dict[str, asyncio.Future]):
+    def __init__(self, sio,
+                 pending_input: Dict[int, asyncio.Future],
+                 pending_confirm: Dict[int, asyncio.Future],
+                 pending_select: Dict[int, asyncio.Future]):
         self.sio = sio
-        self._pending_inputs = pending_inputs
+        self._pending_input = pending_input
+        self._pending_confirm = pending_confirm
+        self._pending_select = pending_select
+        # GUI-facing prompt ids; code_puppy's own ids never leave the sidecar
+        self._prompt_ids = itertools.count(1)
+        # Ids tying chunked content events back together on the GUI side
+        self._stream_ids = itertools.count(1)
+        # Outstanding GUI prompt ids per client, so a disconnect can answer them
+        self._sid_prompt_ids: Dict[str, Set[int]] = defaultdict(set)
+        # Set by the consumer whenever it finds the bus queue empty
+        self._drained = asyncio.Event()
+        # Set (thread-safely) whenever the watched bus gets a new message
+        self._message_ready = asyncio.Event()
+        self._watched_bus = None
+        # Exact request class -> handler, so forwarding is a single dict lookup
+        self._request_handlers = {
+            UserInputRequest: self._handle_input_request,
+            ConfirmationRequest: self._handle_confirmation_request,
+            SelectionRequest: self._handle_selection_request,
+        }
+
+    def _register_prompt(self, sid: str, pending: Dict[int, asyncio.Future]):
+        """Create a pending response future for sid. Returns (gui_id, future)."""
+        gui_id = next(self._prompt_ids)
+        future = asyncio.get_running_loop().create_future()
+        pending[gui_id] = future
+        self._sid_prompt_ids[sid].add(gui_id)
+        return gui_id, future
+
+    def _release_prompt(self, sid: str, pending: Dict[int, asyncio.Future], gui_id: int):
+        """Forget a pending response once it was answered or timed out."""
+        pending.pop(gui_id, None)
+        prompt_ids = self._sid_prompt_ids.get(sid)
+        if prompt_ids is not None:
+            prompt_ids.discard(gui_id)
+            if not prompt_ids:
+                del self._sid_prompt_ids[sid]
+
+    def cancel_pending(self, sid: str):
+        """Answer every prompt still waiting on a disconnected client with its timeout default."""
+        # Resolving (not cancelling) lets each handler reply to the bus and the consumer keep running
+        defaults = (
+            (self._pending_input, ''),
+            (self._pending_confirm, (False, None)),
+            (self._pending_select, []),
+        )
+        for gui_id in self._sid_prompt_ids.pop(sid, ()):
+            for pending, default in defaults:
+                future = pending.pop(gui_id, None)
+                if future is not None:
+                    if not future.done():
+                        future.set_result(default)
+                    break
+
+    def _watch_bus(self, bus: MessageBus):
+        """Wrap bus.emit so every queued message wakes the consumer."""
+        if self._watched_bus is bus:
+            return
+        loop = asyncio.get_running_loop()
+        ready = self._message_ready
+        bus_emit = bus.emit
+
+        def emit(message):
+            bus_emit(message)
+            # Tools may emit from worker threads
+            loop.call_soon_threadsafe(ready.set)
+
+        bus.emit = emit
+        self._watched_bus = bus
+
+    async def wait_until_drained(self, timeout: float = 2.0):
+        """Wait until the consumer has forwarded every message queued so far."""
+        self._drained.clear()
+        # Wake an idle consumer so it re-checks the queue and reports drained
+        self._message_ready.set()
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Message drain timed out after %ss", timeout)
 
     async def consume_messages(self, sid: str, bus: MessageBus):
         """Consume messages from the bus and forward to GUI."""
+        self._watch_bus(bus)
+        ready = self._message_ready
+        request_handlers = self._request_handlers
+        serialize = self.serialize_message
+        get_message = bus.get_message_nowait
+        # One consumer serves one client, so bind the frame emitter once
+        emit_frame = functools.partial(self.sio.emit, 'batch', room=sid)
+        # Bounds unacknowledged output so a fast agent can't grow the send buffer unchecked
+        send = functools.partial(self._send_output, emit_frame, asyncio.Semaphore(MAX_INFLIGHT_FRAMES))
         msg_count = 0
         while True:
             try:
-                try:
-                    msg = bus.get_message_nowait()
-                    if msg is not None:
-                        msg_count += 1
-                        print(f"[Sidecar] Message {msg_count}: {type(msg).__name__}")
-                        sys.stdout.flush()
-                        await self.forward_message(sid, msg, bus)
-                except Empty:
-                    pass
-
-                await asyncio.sleep(0.01)
-            except asyncio.CancelledError:
-                print(f"[Sidecar] Consumer cancelled after {msg_count} messages")
-                sys.stdout.flush()
-                # Drain remaining messages
-                for _ in range(100):
-                    try:
-                        msg = bus.get_message_nowait()
-                        if msg is not None:
-                            await self.forward_message(sid, msg, bus)
-                    except Empty:
+                # Clear before checking so an emit racing the check still wakes us
+                ready.clear()
+                msg = get_message()
+                if msg is None:
+                    self._drained.set()
+                    await ready.wait()
+                    continue
+
+                # Forward everything already queued as one frame, built in wire format
+                batch = []
+                while msg is not None:
+                    msg_count += 1
+                    msg_cls = type(msg)
+                    logger.debug("Message %d: %s", msg_count, msg_cls.__name__)
+                    if msg_cls in request_handlers:
+                        # Output queued before the request must reach the GUI first
+                        if batch:
+                            await send(batch)
+                            batch = []
+                        await self._handle_request(sid, msg, bus)
+                    else:
+                        payload = serialize(msg)
+                        stream = self._large_payload_stream(payload)
+                        if stream:
+                            # Huge output goes one slice per frame so no single encode stalls the loop
+                            if batch:
+                                await send(batch)
+                                batch = []
+                            for event in stream:
+                                await send([event])
+                        elif payload is not None:
+                            batch.append(['message', payload])
+                    if len(batch) >= MAX_BATCH_MESSAGES:
                         break
+                    msg = get_message()
+                if batch:
+                    await send(batch)
+            except asyncio.CancelledError:
+                logger.debug("Consumer cancelled after %d messages", msg_count)
+                # Flush whatever is still queued without waiting for acks; the run is
+                # over, so interactive requests are dropped rather than waited on
+                leftover = []
+                for msg in iter(get_message, None):
+                    if type(msg) in request_handlers:
+                        continue
+                    payload = serialize(msg)
+                    stream = self._large_payload_stream(payload)
+                    if stream:
+                        # Same slicing as the main loop, so a huge output can't stall the flush
+                        if leftover:
+                            await emit_frame(leftover)
+                            leftover = []
+                        for event in stream:
+                            await emit_frame([event])
+                    elif payload is not None:
+                        leftover.append(['message', payload])
+                if leftover:
+                    await emit_frame(leftover)
                 raise
             except Exception as e:
-                print(f"[Sidecar] Consumer error: {e}")
+                logger.exception("Consumer error: %s", e)
+
+    def _large_payload_stream(self, payload: Optional[Dict[str, Any]]) -> Optional[List[list]]:
+        """content_start/chunk/end events for an oversized payload, or None to send it whole."""
+        if payload is None or payload['type'] not in CHUNKED_TYPES:
+            return None
+        return _split_large_payload(payload, self._stream_ids)
 
-    async def forward_message(self, sid: str, msg, bus: MessageBus):
-        """Forward a message to the GUI client."""
+    @staticmethod
+    async def _send_output(emit_frame, send_slots: asyncio.Semaphore, batch: List[list]):
+        """Send a batch frame once the GUI has acked enough earlier ones."""
         try:
-            msg_type = type(msg).__name__
-
-            if isinstance(msg, TextMessage):
-                level_map = {
-                    MessageLevel.DEBUG: 'debug',
-                    MessageLevel.INFO: 'info',
-                    MessageLevel.WARNING: 'warning',
-                    MessageLevel.ERROR: 'error',
-                    MessageLevel.SUCCESS: 'success',
-                }
-                await self.sio.emit('message', {
-                    'type': 'text',
-                    'content': msg.text,
-                    'level': level_map.get(msg.level, 'info')
-                }, room=sid)
-
-            elif isinstance(msg, FileContentMessage):
-                await self.sio.emit('message', {
-                    'type': 'file_content',
-                    'path': msg.path,
-                    'content': msg.content,
-                    'start_line': msg.start_line,
-                    'num_lines': msg.num_lines,
-                    'total_lines': msg.total_lines,
-                    'num_tokens': msg.num_tokens,
-                }, room=sid)
-
-            elif isinstance(msg, DiffMessage):
-                lines = []
-                for line in msg.diff_lines:
-                    prefix = {'add': '+', 'remove': '-', 'context': ' '}.get(line.type, ' ')
-                    lines.append(f"{prefix}{line.content}")
-                await self.sio.emit('message', {
-                    'type': 'diff',
-                    'path': msg.path,
-                    'operation': msg.operation,
-                    'diff_lines': [{'type': l.type, 'content': l.content, 'line_number': l.line_number} for l in msg.diff_lines],
-                    'content': '\n'.join(lines)
-                }, room=sid)
-
-            elif isinstance(msg, ShellStartMessage):
-                await self.sio.emit('message', {
-                    'type': 'shell_start',
-                    'command': msg.command,
-                    'content': f"$ {msg.command}"
-                }, room=sid)
-
-            elif isinstance(msg, ShellOutputMessage):
-                output = msg.stdout + (msg.stderr or '')
-                await self.sio.emit('message', {
-                    'type': 'shell_output',
-                    'command': msg.command,
-                    'stdout': msg.stdout,
-                    'stderr': msg.stderr or '',
-                    'exit_code': msg.exit_code,
-                    'content': output
-                }, room=sid)
-
-            elif isinstance(msg, AgentReasoningMessage):
-                await self.sio.emit('message', {
-                    'type': 'reasoning',
-                    'content': msg.reasoning,
-                    'next_steps': msg.next_steps,
-                }, room=sid)
-
-            elif isinstance(msg, AgentResponseMessage):
-                await self.sio.emit('message', {
-                    'type': 'agent_response',
-                    'content': msg.content
-                }, room=sid)
-
-            elif isinstance(msg, SubAgentInvocationMessage):
-                await self.sio.emit('message', {
-                    'type': 'sub_agent',
-                    'agent_name': msg.agent_name,
-                    'prompt': msg.prompt,
-                    'session_id': msg.session_id,
-                    'is_new_session': msg.is_new_session,
-                    'content': f"[{msg.agent_name}] {msg.prompt[:100]}..."
-                }, room=sid)
-
-            elif isinstance(msg, SubAgentResponseMessage):
-                await self.sio.emit('message', {
-                    'type': 'sub_agent_response',
-                    'agent_name': msg.agent_name,
-                    'session_id': msg.session_id,
-                    'response': msg.response,
-                    'content': msg.response
-                }, room=sid)
-
-            elif isinstance(msg, UserInputRequest):
-                await self._handle_input_request(sid, msg, bus)
-
-            elif isinstance(msg, ConfirmationRequest):
-                await self._handle_confirmation_request(sid, msg, bus)
-
-            elif isinstance(msg, SelectionRequest):
-                await self._handle_selection_request(sid, msg, bus)
-
-            elif isinstance(msg, SpinnerControl):
-                await self.sio.emit('message', {
-                    'type': 'spinner',
-                    'action': msg.action,
-                    'spinner_id': msg.spinner_id,
-                    'content': getattr(msg, 'text', '')
-                }, room=sid)
-
-            elif isinstance(msg, GrepResultMessage):
-                await self.sio.emit('message', {
-                    'type': 'grep_result',
-                    'search_term': msg.search_term,
-                    'directory': msg.directory,
-                    'matches': [{'file_path': m.file_path, 'line_number': m.line_number, 'line_content': m.line_content} for m in msg.matches],
-                    'total_matches': msg.total_matches,
-                    'files_searched': msg.files_searched,
-                }, room=sid)
-
-            elif isinstance(msg, FileListingMessage):
-                await self.sio.emit('message', {
-                    'type': 'file_listing',
-                    'directory': msg.directory,
-                    'files': [{'path': f.path, 'type': f.type, 'size': f.size, 'depth': f.depth} for f in msg.files],
-                    'recursive': msg.recursive,
-                    'total_size': msg.total_size,
-                    'dir_count': msg.dir_count,
-                    'file_count': msg.file_count,
-                }, room=sid)
-
-            elif isinstance(msg, StatusPanelMessage):
-                await self.sio.emit('message', {
-                    'type': 'status_panel',
-                    'title': msg.title,
-                    'fields': msg.fields,
-                }, room=sid)
-
-            elif isinstance(msg, DividerMessage):
-                await self.sio.emit('message', {
-                    'type': 'divider',
-                    'content': '─' * 40
-                }, room=sid)
-
-            elif isinstance(msg, VersionCheckMessage):
-                if msg.update_available:
-                    await self.sio.emit('message', {
-                        'type': 'version_check',
-                        'content': f"Update available: {msg.current_version} → {msg.latest_version}"
-                    }, room=sid)
-
-            else:
-                # Generic fallback
-                content = getattr(msg, 'content', None) or getattr(msg, 'text', None)
-                if content:
-                    await self.sio.emit('message', {
-                        'type': 'text',
-                        'content': str(content)
-                    }, room=sid)
-                else:
-                    print(f"[Sidecar] Unhandled message type: {msg_type}")
+            await asyncio.wait_for(send_slots.acquire(), ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Acks may be lost for good; send this frame outside the window so
+            # requests queued behind it still reach the GUI. The next frame waits again.
+            logger.warning("GUI has not acknowledged output for %gs; sending without a slot", ACK_TIMEOUT)
+            await emit_frame(batch)
+            return
+        try:
+            await emit_frame(batch, callback=lambda *args: send_slots.release())
+        except Exception:
+            send_slots.release()
+            raise
+
+    async def _handle_request(self, sid: str, msg, bus: MessageBus):
+        """Forward a request that needs an answer from the user."""
+        try:
+            await self._request_handlers[type(msg)](sid, msg, bus)
+        except Exception as e:
+            logger.error("Forward error for %s: %s", type(msg).__name__, e)
 
+    def serialize_message(self, msg) -> Optional[Dict[str, Any]]:
+        """Convert a bus message to its 'message' event payload, or None to skip it."""
+        try:
+            serializer = _SERIALIZERS.get(type(msg), _serialize_fallback)
+            return serializer(msg)
         except Exception as e:
-            print(f"[Sidecar] Forward error for {type(msg).__name__}: {e}")
+            logger.error("Forward error for %s: %s", type(msg).__name__, e)
+        return None
 
     async def _handle_input_request(self, sid: str, msg: UserInputRequest, bus: MessageBus):
         """Handle input request."""
-        future = asyncio.Future()
-        self._pending_inputs[msg.prompt_id] = future
+        gui_id, future = self._register_prompt(sid, self._pending_input)
 
         await self.sio.emit('input_request', {
-            'prompt_id': msg.prompt_id,
+            'prompt_id': gui_id,
             'prompt': msg.prompt
         }, room=sid)
 
         try:
-            result = await asyncio.wait_for(future, timeout=300)
-            _, response = result
+            response = await asyncio.wait_for(future, timeout=300)
             bus.provide_response(UserInputResponse(
                 prompt_id=msg.prompt_id,
                 response=response
@@ -259,22 +509,22 @@ class MessageHandler:
                 prompt_id=msg.prompt_id,
                 response=''
             ))
+        finally:
+            self._release_prompt(sid, self._pending_input, gui_id)
 
     async def _handle_confirmation_request(self, sid: str, msg: ConfirmationRequest, bus: MessageBus):
         """Handle confirmation request."""
-        future = asyncio.Future()
-        self._pending_inputs[msg.prompt_id] = future
+        gui_id, future = self._register_prompt(sid, self._pending_confirm)
 
         await self.sio.emit('confirmation_request', {
-            'prompt_id': msg.prompt_id,
+            'prompt_id': gui_id,
             'prompt': msg.prompt,
             'default': getattr(msg, 'default', True),
             'allow_feedback': getattr(msg, 'allow_feedback', False)
         }, room=sid)
 
         try:
-            result = await asyncio.wait_for(future, timeout=300)
-            _, confirmed, feedback = result
+            confirmed, feedback = await asyncio.wait_for(future, timeout=300)
             bus.provide_response(ConfirmationResponse(
                 prompt_id=msg.prompt_id,
                 confirmed=confirmed,
@@ -286,22 +536,22 @@ class MessageHandler:
                 confirmed=False,
                 feedback=None
             ))
+        finally:
+            self._release_prompt(sid, self._pending_confirm, gui_id)
 
     async def _handle_selection_request(self, sid: str, msg: SelectionRequest, bus: MessageBus):
         """Handle selection request."""
-        future = asyncio.Future()
-        self._pending_inputs[msg.prompt_id] = future
+        gui_id, future = self._register_prompt(sid, self._pending_select)
 
         await self.sio.emit('selection_request', {
-            'prompt_id': msg.prompt_id,
+            'prompt_id': gui_id,
             'prompt': msg.prompt,
             'options': [{'label': o.label, 'value': o.value} for o in msg.options],
             'multi_select': getattr(msg, 'multi_select', False)
         }, room=sid)
 
         try:
-            result = await asyncio.wait_for(future, timeout=300)
-            _, selected = result
+            selected = await asyncio.wait_for(future, timeout=300)
             bus.provide_response(SelectionResponse(
                 prompt_id=msg.prompt_id,
                 selected=selected if isinstance(selected, list) else [selected]
@@ -311,3 +561,5 @@ class MessageHandler:
                 prompt_id=msg.prompt_id,
                 selected=[]
             ))
+        finally:
+            self._release_prompt(sid, self._pending_select, gui_id)
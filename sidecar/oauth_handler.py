@@ -3,12 +3,22 @@ OAuth handler for Claude Code authentication.
 """
 
 import asyncio
+import functools
+import logging
+import socket
 import sys
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs, urlparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import Optional, Any
 
+from aiohttp import web
+
+from config_handler import file_mtime_ns, invalidate_models_cache, oauth_models_path
+from message_handler import emit_batch
+
+logger = logging.getLogger("sidecar.oauth")
+
 # Import OAuth utilities
 try:
     from code_puppy.plugins.claude_code_oauth.utils import (
@@ -27,55 +37,82 @@ try:
         CLAUDE_CODE_OAUTH_CONFIG,
         get_token_storage_path,
     )
+
+    # Callback server settings, read once from the plugin config
+    _port_lo, _port_hi = CLAUDE_CODE_OAUTH_CONFIG["callback_port_range"]
+    CALLBACK_PORTS = range(_port_lo, _port_hi + 1)
+    CALLBACK_PATH = '/' + CLAUDE_CODE_OAUTH_CONFIG["redirect_path"].lstrip('/')
+    CALLBACK_TIMEOUT = CLAUDE_CODE_OAUTH_CONFIG.get('callback_timeout', 300)
     OAUTH_AVAILABLE = True
-except ImportError as e:
-    print(f"[Sidecar] OAuth plugin not available: {e}")
+    OAUTH_IMPORT_ERROR = None
+except (ImportError, KeyError) as e:
+    # A plugin config missing callback settings disables OAuth rather than the sidecar.
+    # Reported by OAuthHandler, once logging has been configured.
     OAUTH_AVAILABLE = False
+    OAUTH_IMPORT_ERROR = e
 
+# Optional: lets a login build its model list without re-reading the models file
+try:
+    from code_puppy.plugins.claude_code_oauth.utils import filter_latest_claude_models
+except ImportError:
+    filter_latest_claude_models = None
+
+# Static pages served to the browser by the OAuth callback route
+OAUTH_SUCCESS_HTML = b"""<html><body style="font-family: system-ui; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; background: #18181b; color: #fafafa;">
+<div style="text-align: center;">
+    <h1>Authentication Successful!</h1>
+    <p>You can close this window and return to GUI Puppy.</p>
+</div>
+</body></html>
+"""
+OAUTH_FAIL_HTML = b"""<html><body style="font-family: system-ui; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; background: #18181b; color: #fafafa;">
+<div style="text-align: center;">
+    <h1>Authentication Failed</h1>
+    <p>Missing code or state parameter.</p>
+</div>
+</body></html>
+"""
 
-class OAuthCallbackHandler(BaseHTTPRequestHandler):
-    """HTTP handler for OAuth callback."""
-    oauth_result = {'code': None, 'state': None, 'error': None}
-    oauth_event = threading.Event()
 
-    def do_GET(self):
-        parsed = urlparse(self.path)
-        params = parse_qs(parsed.query)
+@dataclass(slots=True, frozen=True)
+class OAuthTokens:
+    """The stored token fields the sidecar reads."""
 
-        code = params.get('code', [None])[0]
-        state = params.get('state', [None])[0]
+    access_token: str
+    refresh_token: Optional[str] = None
+    expires_at: Optional[float] = None
 
-        if code and state:
-            OAuthCallbackHandler.oauth_result = {'code': code, 'state': state, 'error': None}
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b'''
-                <html><body style="font-family: system-ui; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; background: #18181b; color: #fafafa;">
-                <div style="text-align: center;">
-                    <h1>Authentication Successful!</h1>
-                    <p>You can close this window and return to GUI Puppy.</p>
-                </div>
-                </body></html>
-            ''')
-        else:
-            OAuthCallbackHandler.oauth_result = {'code': None, 'state': None, 'error': 'Missing code or state'}
-            self.send_response(400)
-            self.send_header('Content-Type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b'''
-                <html><body style="font-family: system-ui; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; background: #18181b; color: #fafafa;">
-                <div style="text-align: center;">
-                    <h1>Authentication Failed</h1>
-                    <p>Missing code or state parameter.</p>
-                </div>
-                </body></html>
-            ''')
+    @classmethod
+    def from_stored(cls, data: Optional[dict]) -> Optional['OAuthTokens']:
+        """Build from the plugin's token dict; None when there is no access token."""
+        if not data or not data.get('access_token'):
+            return None
+        return cls(data['access_token'], data.get('refresh_token'), data.get('expires_at'))
 
-        OAuthCallbackHandler.oauth_event.set()
 
-    def log_message(self, format, *args):
-        pass  # Suppress logging
+def plugin_model_names(claude_models: dict) -> list:
+    """Names of the configured models that were added by the Claude Code plugin."""
+    return [
+        name for name, cfg in claude_models.items()
+        if cfg.get('oauth_source') == 'claude-code-plugin'
+    ]
+
+
+class _OAuthFlow:
+    """State of one in-progress OAuth flow; each flow gets its own callback server."""
+
+    __slots__ = ('context', 'runner', 'result', 'done', 'waiter')
+
+    def __init__(self, context):
+        self.context = context
+        self.runner: Optional[web.AppRunner] = None
+        self.result = {'code': None, 'state': None, 'error': None}
+        self.done = asyncio.Event()
+        self.waiter: Optional[asyncio.Task] = None
+
+
+# Lets the callback route find the flow its server was started for
+OAUTH_FLOW_KEY = web.AppKey('oauth_flow', _OAuthFlow)
 
 
 class OAuthHandler:
@@ -83,258 +120,381 @@ class OAuthHandler:
 
     def __init__(self, sio):
         self.sio = sio
-        self._oauth_context = None
-        self._oauth_server = None
-        self._oauth_handler = OAuthCallbackHandler
+        # Most recent flow; starting a new one abandons it
+        self._flow: Optional[_OAuthFlow] = None
+        # (file mtime_ns, parsed contents) of the token and models files; reloaded when the file changes
+        self._token_path = None
+        self._tokens_cache = (None, None)
+        self._claude_models_cache = (None, None)
+        # Token exchange, model fetches and token/model files block; keep them off the event loop
+        self._io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='sidecar-oauth')
+
+        # Without the plugin every request gets the same fixed answer
+        if not OAUTH_AVAILABLE:
+            logger.warning("OAuth plugin not available: %s", OAUTH_IMPORT_ERROR)
+            self.get_status = self._status_unavailable
+            self.start_flow = self._flow_unavailable
+            self.logout = self._flow_unavailable
+
+    async def _status_unavailable(self, sid: str):
+        """Report that the OAuth plugin is not installed."""
+        await self.sio.emit('oauth_status', {
+            'available': False,
+            'authenticated': False,
+            'error': 'OAuth plugin not installed'
+        }, room=sid)
+
+    async def _flow_unavailable(self, sid: str, on_complete_callback=None):
+        """Reject a login or logout because the OAuth plugin is not installed."""
+        await self.sio.emit('oauth_result', {
+            'success': False,
+            'error': 'OAuth plugin not installed'
+        }, room=sid)
+
+    async def _run_blocking(self, func, *args):
+        """Run a blocking OAuth helper on the OAuth worker threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, functools.partial(func, *args))
+
+    def _tokens_file(self):
+        """Path of the plugin's token file, resolved once."""
+        if self._token_path is None:
+            self._token_path = get_token_storage_path()
+        return self._token_path
+
+    def _cached_tokens(self) -> Optional[OAuthTokens]:
+        """Load the stored OAuth tokens, re-reading the file only when its mtime changes."""
+        mtime = file_mtime_ns(self._tokens_file())
+        if mtime is None:
+            return None
+        cached_mtime, tokens = self._tokens_cache
+        if mtime == cached_mtime:
+            return tokens
+        tokens = OAuthTokens.from_stored(load_stored_tokens())
+        self._tokens_cache = (mtime, tokens)
+        return tokens
+
+    def _invalidate_tokens(self):
+        """Force the next _cached_tokens() call to reload from disk."""
+        self._tokens_cache = (None, None)
+
+    def _cached_claude_models(self) -> dict:
+        """Load the filtered Claude Code models, re-reading only when the models file changes."""
+        mtime = file_mtime_ns(oauth_models_path())
+        cached_mtime, models = self._claude_models_cache
+        if models is not None and mtime is not None and mtime == cached_mtime:
+            return models
+        models = load_claude_models_filtered()
+        self._claude_models_cache = (mtime, models)
+        return models
+
+    def _invalidate_claude_models(self):
+        """Force the next _cached_claude_models() call to reload from disk."""
+        self._claude_models_cache = (None, None)
 
     async def get_status(self, sid: str):
         """Get OAuth status."""
-        if not OAUTH_AVAILABLE:
-            await self.sio.emit('oauth_status', {
-                'available': False,
-                'authenticated': False,
-                'error': 'OAuth plugin not installed'
-            }, room=sid)
-            return
-
+        emit = self.sio.emit
         try:
-            tokens = load_stored_tokens()
-            authenticated = bool(tokens and tokens.get('access_token'))
-
-            status = {
-                'available': True,
-                'authenticated': authenticated,
-                'models': [],
-            }
-
-            if authenticated:
-                import time
-                expires_at = tokens.get('expires_at')
-                if expires_at:
-                    remaining = max(0, int(expires_at - time.time()))
-                    hours, minutes = divmod(remaining // 60, 60)
-                    status['expires_in'] = f"{hours}h {minutes}m"
-
-                # Get configured models
-                claude_models = load_claude_models_filtered()
-                status['models'] = [
-                    name for name, cfg in claude_models.items()
-                    if cfg.get('oauth_source') == 'claude-code-plugin'
-                ]
-
-            await self.sio.emit('oauth_status', status, room=sid)
+            status = await self._run_blocking(self._read_status)
+            await emit('oauth_status', status, room=sid)
         except Exception as e:
-            print(f"[Sidecar] Error getting OAuth status: {e}")
-            await self.sio.emit('oauth_status', {
+            logger.error("Error getting OAuth status: %s", e)
+            await emit('oauth_status', {
                 'available': True,
                 'authenticated': False,
                 'error': str(e)
             }, room=sid)
 
+    def _read_status(self) -> dict:
+        """Build the oauth_status payload from stored tokens and models. Blocking."""
+        tokens = self._cached_tokens()
+        authenticated = tokens is not None
+
+        status = {
+            'available': True,
+            'authenticated': authenticated,
+            'models': [],
+        }
+
+        if authenticated:
+            expires_at = tokens.expires_at
+            if expires_at:
+                remaining = max(0, int(expires_at - time.time()))
+                hours, minutes = divmod(remaining // 60, 60)
+                status['expires_in'] = f"{hours}h {minutes}m"
+
+            # Get configured models
+            status['models'] = plugin_model_names(self._cached_claude_models())
+
+        return status
+
+    @staticmethod
+    def _remove_credentials() -> int:
+        """Delete the stored tokens and Claude Code models. Blocking; returns models removed."""
+        token_path = get_token_storage_path()
+        if token_path.exists():
+            token_path.unlink()
+        return remove_claude_code_models()
+
     async def start_flow(self, sid: str, on_complete_callback=None):
         """Start OAuth authentication flow."""
-        if not OAUTH_AVAILABLE:
-            await self.sio.emit('oauth_result', {
-                'success': False,
-                'error': 'OAuth plugin not installed'
-            }, room=sid)
-            return
-
+        emit = self.sio.emit
         try:
+            # A new attempt replaces any flow still waiting for its callback
+            await self._abandon_flow()
+
             # Prepare OAuth context
-            self._oauth_context = prepare_oauth_context()
+            flow = _OAuthFlow(prepare_oauth_context())
 
             # Start callback server
-            result = await self._start_server(self._oauth_context)
+            result = await self._start_server(flow)
             if not result:
-                await self.sio.emit('oauth_result', {
+                await emit('oauth_result', {
                     'success': False,
                     'error': 'Could not start OAuth callback server'
                 }, room=sid)
                 return
+            # Tracked from here on, so a failure below (or a newer flow) frees the port
+            self._flow = flow
 
             # Build authorization URL
-            auth_url = build_authorization_url(self._oauth_context)
+            auth_url = build_authorization_url(flow.context)
 
             # Send URL to client to open in browser
-            await self.sio.emit('oauth_url', {
+            await emit('oauth_url', {
                 'url': auth_url,
-                'redirect_uri': self._oauth_context.redirect_uri
+                'redirect_uri': flow.context.redirect_uri
             }, room=sid)
 
             # Wait for callback in background
-            asyncio.create_task(self._wait_for_callback(sid, on_complete_callback))
+            flow.waiter = asyncio.create_task(self._wait_for_callback(sid, flow, on_complete_callback))
 
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            await self.sio.emit('oauth_result', {
+            logger.exception("Failed to start OAuth flow")
+            await self._abandon_flow()
+            await emit('oauth_result', {
                 'success': False,
-                'error': str(e)
+                'error': f'Could not start OAuth login ({type(e).__name__})'
             }, room=sid)
 
     async def logout(self, sid: str):
         """Remove OAuth tokens."""
-        if not OAUTH_AVAILABLE:
-            await self.sio.emit('oauth_result', {
-                'success': False,
-                'error': 'OAuth plugin not installed'
-            }, room=sid)
-            return
-
+        emit = self.sio.emit
         try:
-            # Remove tokens
-            token_path = get_token_storage_path()
-            if token_path.exists():
-                token_path.unlink()
-
-            # Remove models
-            removed = remove_claude_code_models()
-
-            await self.sio.emit('oauth_result', {
-                'success': True,
-                'message': f'Logged out. Removed {removed} Claude Code models.'
-            }, room=sid)
-
-            # Send updated status
-            await self.sio.emit('oauth_status', {
-                'available': True,
-                'authenticated': False,
-                'models': []
-            }, room=sid)
+            # Remove tokens and models
+            removed = await self._run_blocking(self._remove_credentials)
+            invalidate_models_cache()
+            self._invalidate_tokens()
+            self._invalidate_claude_models()
+
+            # Send result together with the updated status
+            await emit_batch(self.sio, sid, [
+                ('oauth_result', {
+                    'success': True,
+                    'message': f'Logged out. Removed {removed} Claude Code models.'
+                }),
+                ('oauth_status', {
+                    'available': True,
+                    'authenticated': False,
+                    'models': []
+                }),
+            ])
 
         except Exception as e:
-            print(f"[Sidecar] Error during OAuth logout: {e}")
-            await self.sio.emit('oauth_result', {
+            logger.error("Error during OAuth logout: %s", e)
+            await emit('oauth_result', {
                 'success': False,
                 'error': str(e)
             }, room=sid)
 
-    async def _start_server(self, context) -> bool:
-        """Start OAuth callback server."""
-        port_range = CLAUDE_CODE_OAUTH_CONFIG["callback_port_range"]
+    @staticmethod
+    async def _handle_callback(request: web.Request) -> web.Response:
+        """Handle the OAuth redirect from the browser."""
+        flow = request.app[OAUTH_FLOW_KEY]
+        code = request.query.get('code')
+        state = request.query.get('state')
 
-        for port in range(port_range[0], port_range[1] + 1):
+        if code and state:
+            flow.result = {'code': code, 'state': state, 'error': None}
+            response = web.Response(content_type='text/html', body=OAUTH_SUCCESS_HTML)
+        else:
+            flow.result = {'code': None, 'state': None, 'error': 'Missing code or state'}
+            response = web.Response(status=400, content_type='text/html', body=OAUTH_FAIL_HTML)
+
+        # The browser won't reuse this connection; close it so the server can shut down promptly
+        response.force_close()
+        flow.done.set()
+        return response
+
+    @staticmethod
+    def _bind_callback_socket() -> Optional[socket.socket]:
+        """Bind a socket to the first free callback port, or return None if all are taken."""
+        for port in CALLBACK_PORTS:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Match asyncio's listeners; on Windows this flag would allow stealing a busy port
+            if sys.platform != 'win32':
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             try:
-                server = HTTPServer(('localhost', port), OAuthCallbackHandler)
-                assign_redirect_uri(context, port)
-
-                # Reset event
-                OAuthCallbackHandler.oauth_event = threading.Event()
-                OAuthCallbackHandler.oauth_result = {'code': None, 'state': None, 'error': None}
-
-                # Start server in thread
-                def run_server():
-                    server.handle_request()  # Handle single request then stop
-
-                self._oauth_server = server
-                threading.Thread(target=run_server, daemon=True).start()
-
-                print(f"[Sidecar] OAuth callback server started on port {port}")
-                return True
+                sock.bind(('localhost', port))
             except OSError:
+                sock.close()
                 continue
+            return sock
+        return None
+
+    async def _start_server(self, flow: _OAuthFlow) -> bool:
+        """Start the OAuth callback server for a flow."""
+        # Probe ports with bare sockets; the server is built once, on the socket that bound
+        sock = self._bind_callback_socket()
+        if sock is None:
+            return False
+        port = sock.getsockname()[1]
+
+        app = web.Application()
+        app[OAUTH_FLOW_KEY] = flow
+        app.router.add_get(CALLBACK_PATH, self._handle_callback)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.SockSite(runner, sock).start()
+        except OSError:
+            sock.close()
+            await runner.cleanup()
+            return False
+
+        assign_redirect_uri(flow.context, port)
+        flow.runner = runner
+        logger.info("OAuth callback server started on port %d", port)
+        return True
+
+    @staticmethod
+    async def _stop_server(flow: _OAuthFlow):
+        """Shut down a flow's callback server if it is still running."""
+        runner, flow.runner = flow.runner, None
+        if runner is not None:
+            await runner.cleanup()
+
+    async def _abandon_flow(self):
+        """Cancel the current flow's wait and free its callback port."""
+        flow, self._flow = self._flow, None
+        if flow is None:
+            return
+        if flow.waiter is not None and not flow.waiter.done():
+            flow.waiter.cancel()
+        await self._stop_server(flow)
 
-        return False
-
-    async def _wait_for_callback(self, sid: str, on_complete_callback=None):
+    async def _wait_for_callback(self, sid: str, flow: _OAuthFlow, on_complete_callback=None):
         """Wait for OAuth callback and complete authentication."""
-        timeout = CLAUDE_CODE_OAUTH_CONFIG.get('callback_timeout', 300)
+        emit = self.sio.emit
 
         try:
-            # Poll for callback (check every 0.5 seconds)
-            for _ in range(timeout * 2):
-                if OAuthCallbackHandler.oauth_event.is_set():
-                    break
-                await asyncio.sleep(0.5)
-            else:
-                # Timeout
-                await self.sio.emit('oauth_result', {
+            try:
+                await asyncio.wait_for(flow.done.wait(), CALLBACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                await emit('oauth_result', {
                     'success': False,
                     'error': 'OAuth callback timed out'
                 }, room=sid)
                 return
 
-            result = OAuthCallbackHandler.oauth_result
+            # The browser has been answered; the callback port is no longer needed
+            await self._stop_server(flow)
+            result = flow.result
 
             if result.get('error'):
-                await self.sio.emit('oauth_result', {
+                await emit('oauth_result', {
                     'success': False,
                     'error': result['error']
                 }, room=sid)
                 return
 
-            if result.get('state') != self._oauth_context.state:
-                await self.sio.emit('oauth_result', {
+            if result.get('state') != flow.context.state:
+                await emit('oauth_result', {
                     'success': False,
                     'error': 'State mismatch - possible CSRF attack'
                 }, room=sid)
                 return
 
             # Exchange code for tokens
-            await self.sio.emit('message', {
+            await emit('message', {
                 'type': 'status',
                 'content': 'Exchanging authorization code for tokens...'
             }, room=sid)
 
-            tokens = exchange_code_for_tokens(result['code'], self._oauth_context)
+            tokens = await self._run_blocking(exchange_code_for_tokens, result['code'], flow.context)
             if not tokens:
-                await self.sio.emit('oauth_result', {
+                await emit('oauth_result', {
                     'success': False,
                     'error': 'Token exchange failed'
                 }, room=sid)
                 return
 
-            # Save tokens
-            if not save_tokens(tokens):
-                await self.sio.emit('oauth_result', {
-                    'success': False,
-                    'error': 'Failed to save tokens'
-                }, room=sid)
-                return
-
-            # Fetch and add models
-            await self.sio.emit('message', {
+            await emit('message', {
                 'type': 'status',
                 'content': 'Fetching available Claude Code models...'
             }, room=sid)
 
+            # Save tokens while the model list is fetched; the two are independent
             access_token = tokens.get('access_token')
-            models = fetch_claude_code_models(access_token) if access_token else None
+            if access_token:
+                saved, models = await asyncio.gather(
+                    self._run_blocking(save_tokens, tokens),
+                    self._run_blocking(fetch_claude_code_models, access_token),
+                )
+            else:
+                saved, models = await self._run_blocking(save_tokens, tokens), None
+            self._invalidate_tokens()
+            if not saved:
+                await emit('oauth_result', {
+                    'success': False,
+                    'error': 'Failed to save tokens'
+                }, room=sid)
+                return
 
+            final_events = []
+            model_names = None
             if models:
-                add_models_to_extra_config(models)
-                await self.sio.emit('message', {
+                added = await self._run_blocking(add_models_to_extra_config, models)
+                prefix = CLAUDE_CODE_OAUTH_CONFIG.get('prefix')
+                if added and filter_latest_claude_models is not None and prefix is not None:
+                    # The plugin rewrote its models file with exactly these entries
+                    model_names = [prefix + name for name in filter_latest_claude_models(models)]
+                invalidate_models_cache()
+                self._invalidate_claude_models()
+                final_events.append(('message', {
                     'type': 'status',
                     'content': f'Added {len(models)} Claude Code models'
-                }, room=sid)
+                }))
 
             # Call completion callback if provided
             if on_complete_callback:
                 on_complete_callback()
 
-            await self.sio.emit('oauth_result', {
+            final_events.append(('oauth_result', {
                 'success': True,
                 'message': 'Claude Code authentication successful!',
                 'models_added': len(models) if models else 0
-            }, room=sid)
+            }))
 
             # Send updated status
-            claude_models = load_claude_models_filtered()
-            model_names = [
-                name for name, cfg in claude_models.items()
-                if cfg.get('oauth_source') == 'claude-code-plugin'
-            ]
-            await self.sio.emit('oauth_status', {
+            if model_names is None:
+                model_names = plugin_model_names(await self._run_blocking(self._cached_claude_models))
+            final_events.append(('oauth_status', {
                 'available': True,
                 'authenticated': True,
                 'models': model_names
-            }, room=sid)
+            }))
+            await emit_batch(self.sio, sid, final_events)
 
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            await self.sio.emit('oauth_result', {
+            logger.exception("OAuth flow failed")
+            # Details stay in the log; the client only learns what kind of failure it was
+            await emit('oauth_result', {
                 'success': False,
-                'error': str(e)
+                'error': f'OAuth login failed ({type(e).__name__})'
             }, room=sid)
+        finally:
+            await self._stop_server(flow)
+            if self._flow is flow:
+                self._flow = None
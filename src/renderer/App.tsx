@@ -16,7 +16,7 @@ import type {
 
 export function App() {
   const [isProcessing, setIsProcessing] = useState(false);
-  const [pendingPromptId, setPendingPromptId] = useState<string | null>(null);
+  const [pendingPromptId, setPendingPromptId] = useState<number | null>(null);
 
   // Config state
   const [configDialogOpen, setConfigDialogOpen] = useState(false);
@@ -217,7 +217,7 @@ export function App() {
     }
     startStreaming();
 
-    if (pendingPromptId) {
+    if (pendingPromptId !== null) {
       sendInputResponse(pendingPromptId, text);
       setPendingPromptId(null);
     } else {
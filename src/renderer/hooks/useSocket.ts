@@ -74,12 +74,55 @@ export function useSocket(options: UseSocketOptions) {
       callbacksRef.current.onMessage(data);
     });
 
+    // Oversized tool output arrives in slices; reassemble it into one message
+    const pendingContent = new Map<number, { message: Record<string, unknown>; parts: Record<string, string[]> }>();
+
+    socket.on('content_start', (data: { id: number; message: Record<string, unknown>; fields: string[] }) => {
+      const parts: Record<string, string[]> = {};
+      for (const field of data.fields) {
+        parts[field] = [];
+      }
+      pendingContent.set(data.id, { message: data.message, parts });
+    });
+
+    socket.on('content_chunk', (data: { id: number; field: string; seq: number; data: string }) => {
+      const entry = pendingContent.get(data.id);
+      if (entry) {
+        entry.parts[data.field][data.seq] = data.data;
+      }
+    });
+
+    socket.on('content_end', (data: { id: number }) => {
+      const entry = pendingContent.get(data.id);
+      if (!entry) return;
+      pendingContent.delete(data.id);
+      for (const [field, parts] of Object.entries(entry.parts)) {
+        entry.message[field] = parts.join('');
+      }
+      callbacksRef.current.onMessage(entry.message as unknown as SidecarMessage);
+    });
+
     socket.on('stream_chunk', (data: { content: string }) => {
       if (data.content) {
         callbacksRef.current.onStreamChunk(data.content);
       }
     });
 
+    // Several events coalesced by the sidecar into one frame
+    socket.on('batch', (events: [string, unknown][], ack?: () => void) => {
+      try {
+        for (const [event, data] of events) {
+          for (const listener of socket.listeners(event)) {
+            listener(data);
+          }
+        }
+      } finally {
+        // Agent output batches are acked so the sidecar can apply backpressure;
+        // a listener throwing on one bad event must not leave the frame unacked
+        ack?.();
+      }
+    });
+
     socket.on('task_complete', () => {
       callbacksRef.current.onTaskComplete();
     });
@@ -150,7 +193,7 @@ export function useSocket(options: UseSocketOptions) {
     }
   }, []);
 
-  const sendInputResponse = useCallback((promptId: string, response: string) => {
+  const sendInputResponse = useCallback((promptId: number, response: string) => {
     if (socketRef.current?.connected) {
       socketRef.current.emit('input_response', { prompt_id: promptId, response });
     }
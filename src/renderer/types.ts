@@ -121,7 +121,7 @@ export interface SidecarMessage {
 }
 
 export interface InputRequest {
-  prompt_id: string;
+  prompt_id: number;
   prompt: string;
 }
 